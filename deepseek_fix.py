@@ -10,37 +10,62 @@ from typing import Dict, List, Any
 from unittest.mock import patch
 logger = logging.getLogger(__name__)
 
+# 值为 None 时需要从请求中移除的参数（DeepSeek 不接受这些参数的空值）
+_PROBLEMATIC_PARAMS = frozenset({
+    'frequency_penalty', 'presence_penalty', 'logit_bias',
+    'logprobs', 'top_logprobs', 'suffix', 'user', 'tools',
+    'tool_choice', 'response_format'
+})
+
+def _to_dict(message):
+    """将单条消息转换为字典"""
+    # 已经是字典（最常见的情况）
+    if isinstance(message, dict):
+        return message.copy()
+    
+    # 在类上查找转换方法，避免对每个实例做多次 hasattr 探测
+    message_type = type(message)
+    model_dump = getattr(message_type, 'model_dump', None)
+    if model_dump is not None:
+        # Pydantic 对象
+        return model_dump(message)
+    to_dict = getattr(message_type, 'dict', None)
+    if to_dict is not None:
+        # 其他对象的 dict 方法
+        return to_dict(message)
+    
+    # 尝试转换为字典
+    return {
+        'role': getattr(message, 'role', 'user'),
+        'content': getattr(message, 'content', str(message))
+    }
+
+def _get_role(message):
+    """读取消息的角色，不做任何转换"""
+    if isinstance(message, dict):
+        return message.get('role')
+    return getattr(message, 'role', None)
+
 def fix_messages_for_deepseek(messages):
     """
     修复消息中的角色问题
     将 'developer' 角色转换为 'system' 角色
     """
-    fixed_messages = []
+    # 先展开一次性的可迭代对象，避免预检查时被消耗
+    if not isinstance(messages, (list, tuple)):
+        messages = list(messages)
     
-    for message in messages:
-        # 处理不同类型的消息对象
-        if hasattr(message, 'model_dump'):
-            # Pydantic 对象
-            message_dict = message.model_dump()
-        elif hasattr(message, 'dict'):
-            # 其他对象的 dict 方法
-            message_dict = message.dict()
-        elif isinstance(message, dict):
-            # 已经是字典
-            message_dict = message.copy()
-        else:
-            # 尝试转换为字典
-            message_dict = {
-                'role': getattr(message, 'role', 'user'),
-                'content': getattr(message, 'content', str(message))
-            }
-        
-        # 修复不支持的角色
+    # 没有 developer 角色时无需转换，直接返回原消息
+    if not any(_get_role(message) == 'developer' for message in messages):
+        return messages
+    
+    fixed_messages = [_to_dict(message) for message in messages]
+    
+    # 修复不支持的角色
+    for message_dict in fixed_messages:
         if message_dict.get('role') == 'developer':
             message_dict['role'] = 'system'
             logger.debug("DeepSeek Fix: 将 developer 角色转换为 system 角色")
-        
-        fixed_messages.append(message_dict)
     
     return fixed_messages
 
@@ -51,31 +76,45 @@ def apply_deepseek_compatibility_patch():
     try:
         import openai.resources.chat.completions.completions as completions_module
         
-        # 保存原始方法
+        # 已经应用过补丁（例如 Streamlit 热重载时重复导入），避免层层包装
+        if getattr(completions_module.Completions.create, '_deepseek_patched', False):
+            logger.debug("DeepSeek 兼容性补丁已存在，跳过")
+            return True
+        
+        # 保存原始方法（只在第一次应用补丁时读取；保存在闭包中，模块重新加载也不受影响）
         original_create = completions_module.Completions.create
+        original_acreate = completions_module.AsyncCompletions.create
         
-        def patched_create(self, **kwargs):
-            """修补后的 create 方法"""
+        def fix_kwargs(kwargs):
+            """修复请求参数"""
             if 'messages' in kwargs:
                 # 修复消息格式
                 kwargs['messages'] = fix_messages_for_deepseek(kwargs['messages'])
                 
                 # 移除可能导致问题的参数
-                problematic_params = [
-                    'frequency_penalty', 'presence_penalty', 'logit_bias', 
-                    'logprobs', 'top_logprobs', 'suffix', 'user', 'tools', 
-                    'tool_choice', 'response_format'
-                ]
-                
-                for param in problematic_params:
-                    if param in kwargs and kwargs[param] is None:
+                for param in _PROBLEMATIC_PARAMS.intersection(kwargs):
+                    if kwargs[param] is None:
                         del kwargs[param]
+        
+        def patched_create(self, **kwargs):
+            """修补后的 create 方法"""
+            fix_kwargs(kwargs)
             
             # 调用原始方法
             return original_create(self, **kwargs)
         
+        async def patched_acreate(self, **kwargs):
+            """修补后的异步 create 方法（Agent.arun 走这条路径）"""
+            fix_kwargs(kwargs)
+            
+            # 调用原始方法
+            return await original_acreate(self, **kwargs)
+        
         # 应用补丁
+        patched_create._deepseek_patched = True
+        patched_acreate._deepseek_patched = True
         completions_module.Completions.create = patched_create
+        completions_module.AsyncCompletions.create = patched_acreate
         logger.info("DeepSeek 兼容性补丁已应用")
         return True
         
@@ -1,31 +1,76 @@
 import streamlit as st
 import logging
+import hashlib
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import traceback
 from datetime import datetime
-from phi.agent import Agent
-from phi.model.google import Gemini
-from phi.model.openai import OpenAIChat
 import os
+import secrets
+import asyncio
+import atexit
+import collections
+import queue
+import random
+import re
 import threading
 import time
-import uuid
 from concurrent.futures import ThreadPoolExecutor
-import asyncio
-import deepseek_fix
+
 
 # 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("app.log", encoding="utf-8"),
-        logging.StreamHandler(),
-    ],
-)
-# 全局线程池将在主函数中初始化
+@st.cache_resource(show_spinner=False)
+def _setup_logging():
+    """日志先放入队列，由单独的后台线程写入文件；每个进程只配置一次"""
+    # 清空缓存后函数会再次执行，根日志记录器上已有队列处理器时直接复用，避免重复写入日志文件
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers:
+        if isinstance(handler, QueueHandler):
+            return handler.listener
+
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+    app_handler = RotatingFileHandler(
+        "app.log", maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+    )
+    app_handler.setFormatter(formatter)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+
+    # 错误日志额外单独写入 error_logs.txt
+    error_handler = RotatingFileHandler(
+        "error_logs.txt", maxBytes=1_000_000, backupCount=3, encoding="utf-8"
+    )
+    error_handler.setFormatter(
+        logging.Formatter("-" * 50 + "\n[%(asctime)s] %(message)s")
+    )
+    error_handler.addFilter(logging.Filter("health_agent.errors"))
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, app_handler, console_handler, error_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.listener = listener
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(queue_handler)
+    return listener
+
+
+_setup_logging()
+error_logger = logging.getLogger("health_agent.errors")
+
+
+# 获取应用启动时间的函数
+@st.cache_resource(show_spinner=False)
+def _startup_time():
+    """进程第一次运行脚本的时间，之后的重新运行不再重新计算"""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
 # 检测运行环境的函数
+@st.cache_data(show_spinner=False)
 def is_streamlit_cloud():
     """检测是否在Streamlit Cloud环境中运行"""
     return (
@@ -38,7 +83,18 @@ def is_streamlit_cloud():
 
 # 获取API密钥的函数
 def get_api_key():
-    """根据运行环境获取相应的API密钥"""
+    """根据运行环境获取相应的API密钥，成功获取后缓存在会话状态中"""
+    if "_api_key" in st.session_state:
+        return st.session_state._api_key
+
+    api_key = _load_api_key()
+    if api_key:
+        st.session_state._api_key = api_key
+    return api_key
+
+
+def _load_api_key():
+    """从 secrets.toml 或环境变量读取API密钥"""
     try:
         if is_streamlit_cloud():
             # Streamlit Cloud环境，尝试获取Gemini API密钥
@@ -64,22 +120,34 @@ def get_api_key():
         return None
 
 
+# 规范化 base_url 的函数
+def _norm_url(url):
+    """去掉多余的空白和 @ 符号，并确保以 / 结尾（只在缓存的 get_default_config 中调用）"""
+    if not url:
+        return url
+    url = url.strip().replace("@", "")
+    return url if url.endswith("/") else url + "/"
+
+
 # 根据运行环境获取默认配置
+@st.cache_data(show_spinner=False)
 def get_default_config():
-    """根据运行环境返回默认的模型配置"""
+    """根据运行环境返回默认的模型配置（base_url 已规范化）"""
     if is_streamlit_cloud():
         # Streamlit Cloud 环境使用 Gemini
         return {
             "model_provider": os.getenv("MODEL_PROVIDER", "Gemini"),
             "model_name": os.getenv("MODEL_NAME", "gemini-2.5-flash-preview-05-20"),
-            "base_url": os.getenv("URL", "https://aistudio.google.com/apikey"),
+            "base_url": _norm_url(
+                os.getenv("URL", "https://aistudio.google.com/apikey")
+            ),
         }
     else:
         # 本地环境使用 OpenAI
         return {
             "model_provider": os.getenv("MODEL_PROVIDER", "DeepSeek"),
             "model_name": os.getenv("MODEL_NAME", "deepseek-v3"),
-            "base_url": os.getenv("URL"),
+            "base_url": _norm_url(os.getenv("URL")),
         }
 
 
@@ -90,37 +158,74 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
-st.markdown(
-    """
-    <style>
-    .main {
-        padding: 2rem;
-    }
-    .stButton>button {
-        width: 100%;
-        border-radius: 5px;
-        height: 3em;
-    }
-    .success-box {
-        padding: 1rem;
-        border-radius: 0.5rem;
-        background-color: #f0fff4;
-        border: 1px solid #9ae6b4;
-    }
-    .warning-box {
-        padding: 1rem;
-        border-radius: 0.5rem;
-        background-color: #fffaf0;
-        border: 1px solid #fbd38d;
-    }
-    div[data-testid="stExpander"] div[role="button"] p {
-        font-size: 1.1rem;
+# 静态样式和页头内容，每次重新运行都要重新发送给前端
+_CSS_BLOCK = """
+<style>
+.main {
+    padding: 2rem;
+}
+.stButton>button {
+    width: 100%;
+    border-radius: 5px;
+    height: 3em;
+}
+.success-box {
+    padding: 1rem;
+    border-radius: 0.5rem;
+    background-color: #f0fff4;
+    border: 1px solid #9ae6b4;
+}
+.warning-box {
+    padding: 1rem;
+    border-radius: 0.5rem;
+    background-color: #fffaf0;
+    border: 1px solid #fbd38d;
+}
+div[data-testid="stExpander"] div[role="button"] p {
+    font-size: 1.1rem;
+    font-weight: 600;
+}
+</style>
+"""
+
+_HEADER_HTML = """
+<div style='
+    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+    color: white;
+    padding: 2rem;
+    border-radius: 15px;
+    margin-bottom: 2rem;
+    box-shadow: 0 8px 32px rgba(102, 126, 234, 0.3);
+    text-align: center;
+    font-family: "SF Pro Display", -apple-system, BlinkMacSystemFont, sans-serif;
+'>
+    <h3 style='
+        margin: 0 0 1rem 0;
+        font-size: 1.5rem;
         font-weight: 600;
-    }
-    </style>
-""",
-    unsafe_allow_html=True,
-)
+        text-shadow: 0 2px 4px rgba(0,0,0,0.1);
+    '>🎯 个性化健康规划助手</h3>
+    <p style='
+        margin: 0;
+        font-size: 1.1rem;
+        line-height: 1.6;
+        opacity: 0.95;
+        font-weight: 300;
+    '>
+        获取根据您的目标和偏好量身定制的个性化饮食和健身计划。<br>
+        我们由人工智能驱动的系统会考虑您的独特情况，为您创建完美的计划。
+    </p>
+</div>
+"""
+
+
+@st.cache_resource(show_spinner=False)
+def _compact_html(html):
+    """折叠多余空白，减小每次重新运行时发送给前端的内容（每个进程只计算一次）"""
+    return " ".join(html.split())
+
+
+st.markdown(_compact_html(_CSS_BLOCK), unsafe_allow_html=True)
 
 
 def display_dietary_plan(plan_content):
@@ -135,12 +240,9 @@ def display_dietary_plan(plan_content):
 
         with col2:
             st.markdown("### ⚠️ 重要注意事项")
-            considerations = plan_content.get("important_considerations", "").split(
-                "\n"
-            )
-            for consideration in considerations:
-                if consideration.strip():
-                    st.warning(consideration)
+            considerations = plan_content.get("important_considerations", [])
+            if considerations:
+                st.warning("\n".join(f"- {item}" for item in considerations))
 
 
 def display_fitness_plan(plan_content):
@@ -155,144 +257,498 @@ def display_fitness_plan(plan_content):
 
         with col2:
             st.markdown("### 💡 专业提示")
-            tips = plan_content.get("tips", "").split("\n")
-            for tip in tips:
-                if tip.strip():
-                    st.info(tip)
+            tips = plan_content.get("tips", [])
+            if tips:
+                st.info("\n".join(f"- {tip}" for tip in tips))
 
 
-# 异步生成计划的函数
-def generate_plan_async(
-    user_profile, model_provider, model_name, base_url, api_key, plan_type
-):
-    """异步生成饮食或健身计划"""
-    try:
-        # 初始化模型
-        model = None
-        if model_provider == "Gemini":
-            logging.info(f"使用Gemini模型: {model_name}, {base_url}, {api_key}")
-            model = Gemini(id=model_name, api_key=api_key)
-        else:
-            logging.info(f"使用OpenAI模型: {model_name}, {base_url}, {api_key}")
-            model = OpenAIChat(
-                id=model_name,
+# 应用 DeepSeek 兼容性补丁的函数
+def _ensure_deepseek_fix():
+    """导入 deepseek_fix 时会自动应用补丁，模块只会被导入一次"""
+    import deepseek_fix
+
+    return deepseek_fix
+
+
+# 获取全局 HTTP 客户端的函数
+@st.cache_resource(show_spinner=False)
+def _shared_http_clients():
+    """整个进程共享的同步/异步 HTTP 客户端，保持长连接以省去重复的 TCP 和 TLS 握手"""
+    import httpx
+
+    limits = httpx.Limits(max_keepalive_connections=20)
+    return (
+        httpx.Client(timeout=60, limits=limits),
+        httpx.AsyncClient(timeout=60, limits=limits),
+    )
+
+
+# 创建模型对象的函数
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _build_model(model_provider, model_name, base_url, api_key, max_tokens):
+    """创建模型对象，整个进程按配置共享，复用其 HTTP 连接池"""
+    # 只导入当前会话实际使用的模型提供商，缩短冷启动时间
+    if model_provider == "Gemini":
+        from phi.model.google import Gemini
+
+        logging.info(f"使用Gemini模型: {model_name}, {base_url}, {api_key}")
+        return Gemini(id=model_name, api_key=api_key)
+    else:
+        from openai import AsyncOpenAI
+        from phi.model.openai import OpenAIChat
+
+        # DeepSeek 等 OpenAI 兼容服务不接受 developer 角色，只有官方 OpenAI 不需要补丁
+        if model_provider != "OpenAI":
+            _ensure_deepseek_fix()
+
+        logging.info(f"使用OpenAI模型: {model_name}, {base_url}, {api_key}")
+        # phi 每次调用都会新建 OpenAI 客户端，这里传入共享的长连接客户端
+        # 异步客户端只在后台事件循环中使用
+        http_client, async_http_client = _shared_http_clients()
+        return OpenAIChat(
+            id=model_name,
+            api_key=api_key,
+            base_url=base_url,
+            max_tokens=max_tokens,
+            temperature=0.7,
+            http_client=http_client,
+            async_client=AsyncOpenAI(
                 api_key=api_key,
                 base_url=base_url,
-                max_tokens=2000,
-                temperature=0.7,
-            )
+                http_client=async_http_client,
+            ),
+        )
 
-        if plan_type == "dietary":
-            agent = Agent(
-                name="饮食专家",
-                model=model,
-                system_prompt="""你是一位专业的饮食专家。请根据用户的个人信息提供个性化饮食建议：
-                - 考虑用户的输入，包括饮食限制和偏好
-                - 建议一天的详细膳食计划，包括早餐、午餐、晚餐和零食
-                - 简要解释为什么该计划适合用户的目标
-                - 注重建议的清晰性、连贯性和质量
-                请用中文回复。""",
-            )
-        else:  # fitness
-            agent = Agent(
-                name="健身专家",
-                model=model,
-                system_prompt="""你是一位专业的健身专家。请根据用户的个人信息提供个性化健身建议：
-                - 提供根据用户目标量身定制的锻炼计划
-                - 包括热身、主要锻炼和冷却运动
-                - 解释每项推荐锻炼的好处
-                - 确保计划具有可操作性和详细性
-                请用中文回复。""",
-            )
 
-        response = agent.run(user_profile)
+# 获取智能体的函数
+def _get_agent(model, role, **agent_kwargs):
+    """获取当前会话中每个 (模型, 角色) 对应的缓存智能体"""
+    # 智能体运行时会保存 run_response、memory 等状态，只在会话内复用，不在会话之间共享
+    cache = st.session_state.setdefault("_agent_cache", {})
+    cache_key = (id(model), role)
+
+    # 同时保存共享的模型对象，保证它不被回收，id(model) 不会被其他模型复用
+    entry = cache.get(cache_key)
+    if entry is None or entry[0] is not model:
+        from phi.agent import Agent
+
+        # 共享模型的浅拷贝：连接池仍然共享，metrics 等每次运行写入的状态归这个智能体所有
+        agent = Agent(model=model.model_copy(update={"metrics": {}}), **agent_kwargs)
+        entry = cache[cache_key] = (model, agent)
+    return entry[1]
+
+
+def _reset_agent_memory(agent):
+    """清空智能体的对话记忆和模型的运行指标；每次调用都是独立的请求，复用的智能体不应累积历史"""
+    agent.memory.clear()
+    agent.model.metrics = {}
+
+
+# 计算LLM响应缓存键的函数
+def _llm_cache_key(agent, prompt):
+    """根据模型名称、系统提示词和用户输入计算缓存键"""
+    raw = "\0".join((agent.model.id, agent.system_prompt or "", prompt))
+    return hashlib.blake2b(raw.encode()).hexdigest()
+
+
+def _normalize_profile(user_profile):
+    """规范化用户资料：去掉空白行并按行排序，使等价资料命中同一个缓存"""
+    lines = (line.strip() for line in user_profile.splitlines())
+    return "\n".join(sorted(line for line in lines if line))
+
+
+# 带过期时间和容量上限的缓存
+class _TTLCache:
+    """线程安全的LRU缓存，条目超过 ttl 秒后失效"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+# 获取全局计划缓存的函数
+@st.cache_resource(show_spinner=False)
+def get_plan_cache():
+    """整个进程共享的计划缓存，相同的用户资料和模型配置直接复用已生成的计划"""
+    return _TTLCache(ttl=3600, max_entries=256)
+
+
+# 流式运行智能体的函数
+def _cached_stream(agent, prompt):
+    """逐块产出回答；相同的请求直接返回会话中缓存的回答，避免重复调用LLM"""
+    cache = st.session_state.setdefault("_llm_cache", {})
+    key = _llm_cache_key(agent, prompt)
+    if key in cache:
+        logging.info(f"用户 {st.session_state.user_id} 命中LLM响应缓存")
+        yield cache[key]
+        return
+
+    parts = []
+    try:
+        for chunk in agent.run(prompt, stream=True):
+            if chunk.content:
+                parts.append(chunk.content)
+                yield chunk.content
+    finally:
+        _reset_agent_memory(agent)
+
+    if parts:
+        cache[key] = "".join(parts)
+
+
+# 获取全局线程池的函数
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    """整个进程共享一个线程池，用于执行没有异步接口的同步 LLM 调用"""
+    executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm")
+    atexit.register(executor.shutdown, wait=False)
+    return executor
+
+
+# 获取全局事件循环的函数
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """整个进程共享一个在后台线程中常驻的事件循环，复用异步客户端和连接池"""
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(get_executor())
+    threading.Thread(target=loop.run_forever, name="llm-loop", daemon=True).start()
+    return loop
+
+
+# 限流器：限制同时进行的LLM请求数和每分钟请求数
+class _RateLimiter:
+    """基于信号量和滑动窗口的LLM请求限流器，只能在后台事件循环中使用"""
+
+    def __init__(self, concurrency, rpm):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rpm = rpm
+        self._timestamps = collections.deque()
+        self._lock = asyncio.Lock()
+        self._paused_until = 0.0
+
+    def update_from_headers(self, headers):
+        """服务端报告请求数或 token 额度已用完时，暂停发送新请求直到额度重置"""
+        for kind in ("requests", "tokens"):
+            if headers.get(f"x-ratelimit-remaining-{kind}") != "0":
+                continue
+            reset = _parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if reset:
+                # 最多暂停一个限流窗口，之后仍有重试和退避兜底
+                resume_at = time.monotonic() + min(reset, 60)
+                self._paused_until = max(self._paused_until, resume_at)
+
+    async def wait_rpm(self):
+        """等待直到最近一分钟内的请求数低于上限"""
+        async with self._lock:
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            while True:
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= 60:
+                    self._timestamps.popleft()
+                if len(self._timestamps) < self.rpm:
+                    self._timestamps.append(now)
+                    return
+                await asyncio.sleep(60 - (now - self._timestamps[0]))
+
+
+# x-ratelimit-reset-* 头的时间格式，例如 "1s"、"6m0s"、"20ms"
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _parse_duration(value):
+    """把 x-ratelimit-reset-* 头解析为秒数，无法解析时返回 None"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parts = _DURATION_PATTERN.findall(value)
+        return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts) or None
+
+
+# 获取全局限流器的函数
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter():
+    """在后台事件循环中创建整个进程共享的限流器"""
+
+    async def create():
+        return _RateLimiter(
+            int(os.getenv("LLM_CONCURRENCY", "4")), int(os.getenv("LLM_RPM", "60"))
+        )
+
+    return asyncio.run_coroutine_threadsafe(create(), get_event_loop()).result()
+
+
+# LLM请求失败后的最大尝试次数
+_MAX_ATTEMPTS = 5
+
+
+def _retryable_errors(model_provider):
+    """返回遇到后值得重试的异常类型（限流和连接错误）"""
+    if model_provider == "Gemini":
+        from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable
+
+        return (ResourceExhausted, ServiceUnavailable)
+
+    from openai import APIConnectionError, RateLimitError
+
+    return (RateLimitError, APIConnectionError)
+
+
+def _error_headers(error):
+    """读取错误响应的响应头，没有响应时返回空字典"""
+    return getattr(getattr(error, "response", None), "headers", None) or {}
+
+
+def _retry_delay(error, attempt):
+    """计算重试前的等待时间：优先使用服务端返回的 retry-after，否则指数退避加抖动"""
+    retry_after = _error_headers(error).get("retry-after")
+    try:
+        return min(float(retry_after), 30.0)
+    except (TypeError, ValueError):
+        return min(2 ** (attempt - 1), 30) + random.uniform(0, 1)
+
+
+async def _astream(agent, model_provider, message):
+    """异步逐块产出智能体的回复内容"""
+    if model_provider == "Gemini":
+        # phi 的 Gemini 模型没有异步接口，每取一块都放到线程池中执行以免阻塞事件循环
+        chunks = agent.run(message, stream=True)
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            if chunk.content:
+                yield chunk.content
+    else:
+        async for chunk in await agent.arun(message, stream=True):
+            if chunk.content:
+                yield chunk.content
+
+
+# 计划智能体的系统提示词
+_DIETARY_SYSTEM_PROMPT = """你是一位专业的饮食专家。请根据用户的个人信息提供个性化饮食建议：
+- 考虑用户的输入，包括饮食限制和偏好
+- 建议一天的详细膳食计划，包括早餐、午餐、晚餐和零食
+- 简要解释为什么该计划适合用户的目标
+- 注重建议的清晰性、连贯性和质量
+请用中文回复。"""
+
+_FITNESS_SYSTEM_PROMPT = """你是一位专业的健身专家。请根据用户的个人信息提供个性化健身建议：
+- 提供根据用户目标量身定制的锻炼计划
+- 包括热身、主要锻炼和冷却运动
+- 解释每项推荐锻炼的好处
+- 确保计划具有可操作性和详细性
+请用中文回复。"""
+
+
+# 获取计划智能体的函数
+def _get_plan_agent(model, plan_type):
+    """获取生成饮食或健身计划的智能体"""
+    if plan_type == "dietary":
+        return _get_agent(
+            model, plan_type, name="饮食专家", system_prompt=_DIETARY_SYSTEM_PROMPT
+        )
+    else:  # fitness
+        return _get_agent(
+            model, plan_type, name="健身专家", system_prompt=_FITNESS_SYSTEM_PROMPT
+        )
 
-        if not response or not hasattr(response, "content"):
-            return None
 
-        return response.content
+# 异步生成计划的函数（运行在后台事件循环中，不能访问 Streamlit 上下文）
+async def generate_plan(
+    agent, model_provider, user_profile, plan_type, on_update, limiter
+):
+    """异步生成饮食或健身计划，生成中的内容通过 on_update 回传给脚本线程"""
+    try:
+        retryable_errors = _retryable_errors(model_provider)
+        for attempt in range(1, _MAX_ATTEMPTS + 1):
+            content = ""
+            try:
+                async with limiter.semaphore:
+                    await limiter.wait_rpm()
+                    async for chunk in _astream(agent, model_provider, user_profile):
+                        content += chunk
+                        on_update((plan_type, content))
+
+                return content or None
+
+            except retryable_errors as e:
+                # 按服务端报告的剩余额度暂停所有请求，而不只是当前这一个
+                limiter.update_from_headers(_error_headers(e))
+                # 已经输出了部分内容时不再重试，避免内容重复
+                if content or attempt == _MAX_ATTEMPTS:
+                    raise
+                delay = _retry_delay(e, attempt)
+                logging.warning(
+                    f"生成{plan_type}计划被限流或连接失败，{delay:.1f}秒后进行第{attempt}次重试: {str(e)}"
+                )
+                await asyncio.sleep(delay)
 
     except Exception as e:
         logging.error(f"生成{plan_type}计划时出错: {str(e)}")
         return None
 
+    finally:
+        _reset_agent_memory(agent)
+
+
+async def generate_both(agents, model_provider, user_profile, on_update, limiter):
+    """在同一个事件循环中并发生成多个计划，结束时回传 None 作为结束标记"""
+    try:
+        contents = await asyncio.gather(
+            *(
+                generate_plan(
+                    agent, model_provider, user_profile, plan_type, on_update, limiter
+                )
+                for plan_type, agent in agents.items()
+            )
+        )
+        return dict(zip(agents, contents))
+    finally:
+        on_update(None)
+
+
+# 生成计划的函数
+def generate_plans(
+    user_profile,
+    model_provider,
+    model_name,
+    base_url,
+    api_key,
+    placeholders,
+    use_cache=True,
+):
+    """在后台事件循环中并发生成计划，并在脚本线程中把生成中的内容写入 placeholders"""
+    model = _build_model(model_provider, model_name, base_url, api_key, 2000)
+    cache = get_plan_cache()
+    profile_key = f"{model_provider}\0{_normalize_profile(user_profile)}"
+
+    results = {}
+    pending = {}
+    keys = {}
+    for plan_type, placeholder in placeholders.items():
+        agent = _get_plan_agent(model, plan_type)
+        keys[plan_type] = _llm_cache_key(agent, profile_key)
+        cached = cache.get(keys[plan_type]) if use_cache else None
+        if cached is not None:
+            logging.info(f"用户 {st.session_state.user_id} 命中{plan_type}计划缓存")
+            results[plan_type] = cached
+            placeholder.markdown(cached)
+        else:
+            pending[plan_type] = agent
+
+    if pending:
+        updates = queue.SimpleQueue()
+        future = asyncio.run_coroutine_threadsafe(
+            generate_both(
+                pending, model_provider, user_profile, updates.put, get_rate_limiter()
+            ),
+            get_event_loop(),
+        )
+        try:
+            while (update := updates.get()) is not None:
+                plan_type, content = update
+                placeholders[plan_type].markdown(content)
+            contents = future.result()
+        except BaseException:
+            # 脚本被中断（用户停止或触发重新运行）时取消后台任务，不再占用限流额度
+            future.cancel()
+            raise
+
+        for plan_type, content in contents.items():
+            results[plan_type] = content
+            if content:
+                cache.set(keys[plan_type], content)
+
+    return results
+
+
+# 问答智能体的系统提示词
+_QA_SYSTEM_PROMPT = (
+    "你是一位健康和健身专家。请根据提供的饮食和健身计划回答用户的问题。用中文回复。"
+)
+
+
+# 获取问答智能体的函数
+def _get_qa_agent(model):
+    """获取回答用户问题的智能体，在会话内复用"""
+    return _get_agent(model, "qa", system_prompt=_QA_SYSTEM_PROMPT)
+
+
+# 问答历史最多保留的条数
+_MAX_QA_PAIRS = 20
+
+
+def _format_qa_pair(question, answer):
+    """把一条问答格式化为 markdown"""
+    return f"**问:** {question}\n\n**答:** {answer}"
+
 
 # 初始化session state的函数
 def init_session_state():
     """初始化用户会话状态"""
-    if "user_id" not in st.session_state:
-        st.session_state.user_id = str(uuid.uuid4())
+    # 每个会话只需要初始化一次，之后的重新运行只做这一次查找
+    if st.session_state.get("_initialized"):
+        return
 
-    if "executor" not in st.session_state:
-        st.session_state.executor = ThreadPoolExecutor(max_workers=10)
+    if "user_id" not in st.session_state:
+        st.session_state.user_id = secrets.token_hex(8)
 
     if "dietary_plan" not in st.session_state:
         st.session_state.dietary_plan = {}
         st.session_state.fitness_plan = {}
-        st.session_state.qa_pairs = []
+        st.session_state.qa_pairs = collections.deque(maxlen=_MAX_QA_PAIRS)
         st.session_state.plans_generated = False
-        st.session_state.generation_status = (
-            "idle"  # idle, generating, completed, error
-        )
-        st.session_state.generation_progress = 0
-        st.session_state.current_task = ""
+        st.session_state.generation_status = "idle"  # idle, completed
         logging.info(f"用户 {st.session_state.user_id} 会话状态初始化完成")
 
+    st.session_state["_initialized"] = True
+
 
 def main():
     # 初始化会话状态
     init_session_state()
 
-    # 应用启动日志
-    startup_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    logging.info(
-        f"AI 健康与健身规划器启动 - 时间: {startup_time} - 用户: {st.session_state.user_id}"
-    )
-
     st.title("🏋️‍♂️ AI 健康与健身规划器")
-    st.markdown(
-        """
-        <div style='
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 2rem;
-            border-radius: 15px;
-            margin-bottom: 2rem;
-            box-shadow: 0 8px 32px rgba(102, 126, 234, 0.3);
-            text-align: center;
-            font-family: "SF Pro Display", -apple-system, BlinkMacSystemFont, sans-serif;
-        '>
-            <h3 style='
-                margin: 0 0 1rem 0;
-                font-size: 1.5rem;
-                font-weight: 600;
-                text-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            '>🎯 个性化健康规划助手</h3>
-            <p style='
-                margin: 0;
-                font-size: 1.1rem;
-                line-height: 1.6;
-                opacity: 0.95;
-                font-weight: 300;
-            '>
-                获取根据您的目标和偏好量身定制的个性化饮食和健身计划。<br>
-                我们由人工智能驱动的系统会考虑您的独特情况，为您创建完美的计划。
-            </p>
-        </div>
-    """,
-        unsafe_allow_html=True,
-    )
+    st.markdown(_compact_html(_HEADER_HTML), unsafe_allow_html=True)
 
     # 根据运行环境获取默认配置
     default_config = get_default_config()
     api_key_to_use = get_api_key()
 
-    # 记录运行环境和配置信息
+    # 记录启动、运行环境和配置信息（每个会话只记录一次）
     is_cloud = is_streamlit_cloud()
-    logging.info(
-        f"用户 {st.session_state.user_id} - 运行环境: {'Streamlit Cloud' if is_cloud else '本地环境'}"
-    )
-    logging.info(f"用户 {st.session_state.user_id} - 默认配置: {default_config}")
+    if "startup_logged" not in st.session_state:
+        logging.info(
+            f"AI 健康与健身规划器启动 - 时间: {_startup_time()} - 用户: {st.session_state.user_id}"
+        )
+        logging.info(
+            f"用户 {st.session_state.user_id} - 运行环境: {'Streamlit Cloud' if is_cloud else '本地环境'}"
+        )
+        logging.info(f"用户 {st.session_state.user_id} - 默认配置: {default_config}")
+        st.session_state.startup_logged = True
 
     # 使用环境默认配置
     model_provider = default_config["model_provider"]
@@ -334,12 +790,20 @@ def main():
             )
         return
 
-    logging.info(f"用户 {st.session_state.user_id} - model_provider: {model_provider}")
-    logging.info(f"用户 {st.session_state.user_id} - model_name: {model_name}")
-    logging.info(f"用户 {st.session_state.user_id} - base_url: {base_url}")
-    logging.info(
-        f"用户 {st.session_state.user_id} - api_key: {api_key_to_use[:10] if api_key_to_use else 'None'}..."
+    # 模型配置只在发生变化时记录一次
+    model_config = (
+        model_provider,
+        model_name,
+        base_url,
+        f"{api_key_to_use[:10]}..." if api_key_to_use else None,
     )
+    if st.session_state.get("_last_model_config") != model_config:
+        logging.info(
+            "用户 %s - 模型配置 (model_provider, model_name, base_url, api_key): %s",
+            st.session_state.user_id,
+            model_config,
+        )
+        st.session_state._last_model_config = model_config
 
     # 显示当前环境和模型配置状态
     # with st.sidebar:
@@ -386,95 +850,20 @@ def main():
             help="您想实现什么目标？",
         )
 
-    # 显示生成状态
-    if st.session_state.generation_status == "generating":
-        progress_bar = st.progress(st.session_state.generation_progress)
-        st.info(f"🔄 {st.session_state.current_task}")
-
-        # 检查异步任务是否完成
-        if "plan_futures" in st.session_state:
-            dietary_future, fitness_future = st.session_state.plan_futures
-
-            if dietary_future.done() and fitness_future.done():
-                try:
-                    dietary_content = dietary_future.result()
-                    fitness_content = fitness_future.result()
-
-                    if dietary_content and fitness_content:
-                        dietary_plan = {
-                            "why_this_plan_works": "高蛋白、健康脂肪、适量碳水化合物和热量平衡",
-                            "meal_plan": dietary_content,
-                            "important_considerations": """
-                            - 补水：全天多喝水
-                            - 电解质：监测钠、钾和镁的水平
-                            - 纤维：通过蔬菜和水果确保摄入足量
-                            - 倾听身体的声音：根据需要调整份量
-                            """,
-                        }
-
-                        fitness_plan = {
-                            "goals": "增强力量、提高耐力并保持整体健康",
-                            "routine": fitness_content,
-                            "tips": """
-                            - 定期跟踪您的进展
-                            - 锻炼之间保证适当的休息
-                            - 注重正确的姿势
-                            - 坚持您的日常锻炼
-                            """,
-                        }
-
-                        st.session_state.dietary_plan = dietary_plan
-                        st.session_state.fitness_plan = fitness_plan
-                        st.session_state.plans_generated = True
-                        st.session_state.generation_status = "completed"
-                        st.session_state.generation_progress = 100
-                        st.session_state.current_task = "✅ 计划生成完成！"
-
-                        # 清理future对象
-                        del st.session_state.plan_futures
-
-                        logging.info(f"用户 {st.session_state.user_id} 计划生成成功")
-                        st.rerun()
-                    else:
-                        st.session_state.generation_status = "error"
-                        st.error("❌ 计划生成失败，请重试")
-                        if "plan_futures" in st.session_state:
-                            del st.session_state.plan_futures
-
-                except Exception as e:
-                    st.session_state.generation_status = "error"
-                    st.error(f"❌ 生成计划时发生错误: {str(e)}")
-                    logging.error(
-                        f"用户 {st.session_state.user_id} 计划生成失败: {str(e)}"
-                    )
-                    if "plan_futures" in st.session_state:
-                        del st.session_state.plan_futures
-            else:
-                # 更新进度
-                progress = 20
-                if dietary_future.done():
-                    progress += 40
-                if fitness_future.done():
-                    progress += 40
-                st.session_state.generation_progress = progress
-
-                # 自动刷新页面
-                time.sleep(1)
-                st.rerun()
-
     # 生成计划按钮
-    if st.button(
-        "🎯 生成我的个性化计划",
-        use_container_width=True,
-        disabled=(st.session_state.generation_status == "generating"),
-    ):
+    force_regenerate = st.checkbox(
+        "强制重新生成", help="不使用缓存，重新调用模型生成计划"
+    )
+
+    if st.button("🎯 生成我的个性化计划", use_container_width=True):
         try:
-            logging.info(
-                f"用户 {st.session_state.user_id.strip()} 开始生成计划，用户资料: 昵称:{name.strip()},"
-                + f"年龄:{age}, 体重:{weight}, "
-                + f"身高:{height}, 性别:{sex.strip()}, 活动水平:{activity_level.strip()}, "
-                + f"饮食偏好:{dietary_preferences.strip()}, 健身目标:{fitness_goals.strip()}"
-            )
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info(
+                    f"用户 {st.session_state.user_id.strip()} 开始生成计划，用户资料: 昵称:{name.strip()},"
+                    + f"年龄:{age}, 体重:{weight}, "
+                    + f"身高:{height}, 性别:{sex.strip()}, 活动水平:{activity_level.strip()}, "
+                    + f"饮食偏好:{dietary_preferences.strip()}, 健身目标:{fitness_goals.strip()}"
+                )
 
             user_profile = f"""
             年龄: {age}
@@ -486,65 +875,91 @@ def main():
             健身目标: {fitness_goals}
             """
 
-            # 设置生成状态
-            st.session_state.generation_status = "generating"
-            st.session_state.generation_progress = 10
-            st.session_state.current_task = "🚀 正在启动计划生成..."
-            st.session_state.qa_pairs = []
-
-            # 异步提交任务
-            executor = st.session_state.executor
-            dietary_future = executor.submit(
-                generate_plan_async,
+            st.session_state.qa_pairs = collections.deque(maxlen=_MAX_QA_PAIRS)
+
+            # 两个计划在同一个事件循环中并发生成，生成中的内容实时显示
+            stream_area = st.empty()
+            with stream_area.container():
+                stream_col1, stream_col2 = st.columns(2)
+                with stream_col1:
+                    st.markdown("### 🍽️ 正在生成饮食计划...")
+                    dietary_placeholder = st.empty()
+                with stream_col2:
+                    st.markdown("### 🏋️‍♂️ 正在生成健身计划...")
+                    fitness_placeholder = st.empty()
+
+            started_at = time.monotonic()
+            results = generate_plans(
                 user_profile,
                 model_provider,
                 model_name,
                 base_url,
                 api_key_to_use,
-                "dietary",
+                {"dietary": dietary_placeholder, "fitness": fitness_placeholder},
+                use_cache=not force_regenerate,
             )
-            fitness_future = executor.submit(
-                generate_plan_async,
-                user_profile,
-                model_provider,
-                model_name,
-                base_url,
-                api_key_to_use,
-                "fitness",
-            )
-
-            st.session_state.plan_futures = (dietary_future, fitness_future)
-            st.session_state.current_task = "🍽️ 正在生成饮食计划和健身计划..."
-            st.session_state.generation_progress = 20
-
-            st.rerun()
+            dietary_content = results.get("dietary")
+            fitness_content = results.get("fitness")
+            # 生成完成后由下方的计划展示区接管
+            stream_area.empty()
+
+            if dietary_content and fitness_content:
+                dietary_plan = {
+                    "why_this_plan_works": "高蛋白、健康脂肪、适量碳水化合物和热量平衡",
+                    "meal_plan": dietary_content,
+                    "important_considerations": [
+                        "补水：全天多喝水",
+                        "电解质：监测钠、钾和镁的水平",
+                        "纤维：通过蔬菜和水果确保摄入足量",
+                        "倾听身体的声音：根据需要调整份量",
+                    ],
+                }
+
+                fitness_plan = {
+                    "goals": "增强力量、提高耐力并保持整体健康",
+                    "routine": fitness_content,
+                    "tips": [
+                        "定期跟踪您的进展",
+                        "锻炼之间保证适当的休息",
+                        "注重正确的姿势",
+                        "坚持您的日常锻炼",
+                    ],
+                }
+
+                st.session_state.dietary_plan = dietary_plan
+                st.session_state.fitness_plan = fitness_plan
+                st.session_state.plans_generated = True
+                st.session_state.generation_status = "completed"
+
+                logging.info(
+                    "用户 %s 计划生成成功，耗时 %.2fs",
+                    st.session_state.user_id,
+                    time.monotonic() - started_at,
+                )
+            else:
+                st.session_state.generation_status = "idle"
+                st.error("❌ 计划生成失败，请重试")
 
         except Exception as e:
             error_msg = str(e)
-            error_traceback = traceback.format_exc()
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
             # 重置状态
-            st.session_state.generation_status = "error"
-            if "plan_futures" in st.session_state:
-                del st.session_state.plan_futures
+            st.session_state.generation_status = "idle"
 
-            # 详细日志记录
-            logging.error(
-                f"用户 {st.session_state.user_id} 计划生成失败 - 时间: {timestamp}"
+            # 详细日志记录（堆栈跟踪由 logging 格式化一次，写入 app.log 和 error_logs.txt）
+            error_logger.exception(
+                f"用户 {st.session_state.user_id} 计划生成失败 - "
+                f"用户配置: 年龄={age}, 体重={weight}, 身高={height}, 性别={sex} - "
+                f"错误信息: {error_msg}"
             )
-            logging.error(
-                f"用户配置: 年龄={age}, 体重={weight}, 身高={height}, 性别={sex}"
-            )
-            logging.error(f"错误信息: {error_msg}")
-            logging.error(f"完整堆栈跟踪:\n{error_traceback}")
 
             st.error(f"❌ 生成计划时发生错误:")
             st.error(f"错误详情: {error_msg}")
 
             # 在界面上显示详细错误信息
             with st.expander("🔍 详细错误信息（用于调试）", expanded=False):
-                st.code(error_traceback)
+                st.code(traceback.format_exc())
                 st.markdown(f"**时间戳:** {timestamp}")
                 st.markdown(
                     f"**用户配置:** 年龄={age}, 体重={weight}, 身高={height}, 性别={sex}"
@@ -579,17 +994,6 @@ def main():
                     "- 检查所有配置参数\n- 重新启动应用\n- 联系 API 提供商确认服务状态"
                 )
 
-            # 记录详细错误到日志文件
-            try:
-                with open("error_logs.txt", "a", encoding="utf-8") as f:
-                    f.write(
-                        f"\n[{timestamp}] 用户 {st.session_state.user_id} 计划生成错误: {error_msg}\n"
-                    )
-                    f.write(f"堆栈跟踪: {error_traceback}\n")
-                    f.write("-" * 50 + "\n")
-            except Exception as log_error:
-                logging.error(f"写入日志文件失败: {log_error}")
-
     # 显示已生成的计划
     if (
         st.session_state.plans_generated
@@ -605,13 +1009,9 @@ def main():
                 # 重置状态
                 st.session_state.plans_generated = False
                 st.session_state.generation_status = "idle"
-                st.session_state.generation_progress = 0
-                st.session_state.current_task = ""
                 st.session_state.dietary_plan = {}
                 st.session_state.fitness_plan = {}
-                st.session_state.qa_pairs = []
-                if "plan_futures" in st.session_state:
-                    del st.session_state.plan_futures
+                st.session_state.qa_pairs = collections.deque(maxlen=_MAX_QA_PAIRS)
                 st.rerun()
 
     if st.session_state.plans_generated:
@@ -628,36 +1028,28 @@ def main():
                     full_context = f"{context}\n用户问题: {question_input}"
 
                     # 初始化问答模型
-                    qa_model = None
-                    if model_provider == "Gemini":
-                        qa_model = Gemini(id=model_name, api_key=api_key_to_use)
-                    elif model_provider == "OpenAI":
-                        clean_base_url = base_url.strip().replace("@", "")
-                        if not clean_base_url.endswith("/"):
-                            clean_base_url += "/"
-                        qa_model = OpenAIChat(
-                            id=model_name,
-                            api_key=api_key_to_use,
-                            base_url=clean_base_url,
-                            max_tokens=1000,
-                            temperature=0.7,
-                        )
-
-                    agent = Agent(
-                        model=qa_model,
-                        system_prompt="你是一位健康和健身专家。请根据提供的饮食和健身计划回答用户的问题。用中文回复。",
+                    qa_model = _build_model(
+                        model_provider, model_name, base_url, api_key_to_use, 1000
                     )
 
-                    with st.spinner("正在为您寻找最佳答案..."):
-                        run_response = agent.run(full_context)
+                    agent = _get_qa_agent(qa_model)
 
-                        if hasattr(run_response, "content"):
-                            answer = run_response.content
-                        else:
-                            answer = "抱歉，目前无法生成回应。"
+                    # 流式显示回答，写入问答历史后清除临时内容
+                    started_at = time.monotonic()
+                    answer_placeholder = st.empty()
+                    with answer_placeholder.container():
+                        answer = st.write_stream(_cached_stream(agent, full_context))
+                    answer_placeholder.empty()
 
-                        st.session_state.qa_pairs.append((question_input, answer))
-                        logging.info(f"用户 {st.session_state.user_id} 问答成功")
+                    if not answer:
+                        answer = "抱歉，目前无法生成回应。"
+
+                    st.session_state.qa_pairs.append((question_input, answer))
+                    logging.info(
+                        "用户 %s 问答成功，耗时 %.2fs",
+                        st.session_state.user_id,
+                        time.monotonic() - started_at,
+                    )
 
                 except Exception as e:
                     st.error(f"❌ 获取答案时发生错误: {e}")
@@ -665,9 +1057,16 @@ def main():
 
         if st.session_state.qa_pairs:
             st.header("💬 问答历史")
-            for question, answer in st.session_state.qa_pairs:
-                st.markdown(f"**问:** {question}")
-                st.markdown(f"**答:** {answer}")
+            # 最新的问答直接显示，更早的问答合并成一个 markdown 放在折叠区中
+            *earlier_pairs, (question, answer) = st.session_state.qa_pairs
+            st.markdown(_format_qa_pair(question, answer))
+            if earlier_pairs:
+                with st.expander(f"更早的问答（{len(earlier_pairs)}）", expanded=False):
+                    st.markdown(
+                        "\n\n---\n\n".join(
+                            _format_qa_pair(q, a) for q, a in reversed(earlier_pairs)
+                        )
+                    )
 
 
 if __name__ == "__main__":